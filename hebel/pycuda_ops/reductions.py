@@ -130,12 +130,13 @@ def _matrix_sum_out_axis_wrapper():
 
         if axis == 0:
             vec_shape = (N, 1)
+            cache_key = (vec_shape, mat.dtype)
             try:
-                ones = one_vector_cache[vec_shape]
+                ones = one_vector_cache[cache_key]
             except KeyError:
                 ones = gpuarray.empty(vec_shape, dtype=mat.dtype,
                                       allocator=memory_pool.allocate).fill(1.)
-                if cache_one_vector: one_vector_cache[vec_shape] = ones
+                if cache_one_vector: one_vector_cache[cache_key] = ones
 
             if target is None:
                 target = gpuarray.empty((M,), mat.dtype, allocator=memory_pool.allocate)
@@ -147,12 +148,13 @@ def _matrix_sum_out_axis_wrapper():
             linalg.dot(mat, ones, transa='T', target=target)
         elif axis == 1:
             vec_shape = (M, 1)
+            cache_key = (vec_shape, mat.dtype)
             try:
-                ones = one_vector_cache[vec_shape]
+                ones = one_vector_cache[cache_key]
             except KeyError:
                 ones = gpuarray.empty((M, 1), dtype=mat.dtype,
                                       allocator=memory_pool.allocate).fill(1.)
-                if cache_one_vector: one_vector_cache[vec_shape] = ones
+                if cache_one_vector: one_vector_cache[cache_key] = ones
 
             if target is None:
                 target = gpuarray.empty((N,), mat.dtype, allocator=memory_pool.allocate)
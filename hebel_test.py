@@ -19,9 +19,9 @@ hebel.init(0)
 
 import unittest
 import random
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from pycuda import gpuarray
-from pycuda.curandom import rand as curand
 from hebel import sampler, memory_pool
 from hebel.models import NeuralNet, NeuralNetRegression
 from hebel.optimizers import SGD
@@ -34,13 +34,20 @@ from hebel.schedulers import exponential_scheduler, linear_scheduler_up, \
 from hebel.pycuda_ops.matrix import extract_columns, insert_columns
 from hebel.pycuda_ops.elementwise import sample_dropout_mask
 
+random.seed(0)
+rng = np.random.RandomState(0)
+
 
 class TestNeuralNetMNIST(unittest.TestCase):
-    def setUp(self):
-        self.train_data = MNISTDataProvider('train', 100)
-        self.test_data = MNISTDataProvider('test')
-        self.D = self.train_data.D
-        self.n_out = 10
+    @classmethod
+    def setUpClass(cls):
+        cls.train_data = MNISTDataProvider('train', 100)
+        cls.test_data = MNISTDataProvider('test')
+        cls.D = cls.train_data.D
+        cls.n_out = 10
+
+    def tearDown(self):
+        memory_pool.free_held()
 
     def test_relu(self):
         model = NeuralNet(n_in=self.D, n_out=self.n_out,
@@ -53,7 +60,6 @@ class TestNeuralNetMNIST(unittest.TestCase):
         optimizer.run(20)
         self.assertLess(optimizer.progress_monitor.train_error[-1][1],
                         optimizer.progress_monitor.train_error[0][1])
-        del model, optimizer
 
     def test_momentum(self):
         model = NeuralNet(n_in=self.D, n_out=self.n_out,
@@ -67,7 +73,6 @@ class TestNeuralNetMNIST(unittest.TestCase):
         optimizer.run(20)
         self.assertLess(optimizer.progress_monitor.train_error[-1][1],
                         optimizer.progress_monitor.train_error[0][1])
-        del model, optimizer
 
     def test_nesterov_momentum(self):
         model = NeuralNet(n_in=self.D, n_out=self.n_out,
@@ -81,106 +86,144 @@ class TestNeuralNetMNIST(unittest.TestCase):
         optimizer.run(20)
         self.assertLess(optimizer.progress_monitor.train_error[-1][1],
                         optimizer.progress_monitor.train_error[0][1])
-        del model, optimizer
 
 
 class TestColumnSlicing(unittest.TestCase):
+    def tearDown(self):
+        memory_pool.free_held()
+
     def test_extract_columns(self):
         for _ in range(20):
             dtype = random.choice((np.float32, np.float64))
-            N = np.random.randint(100, 1000)
-            M = np.random.randint(100, 1000)
-            a = np.random.randint(0, M)
-            b = np.random.randint(a + 1, M)
+            N = rng.randint(100, 1000)
+            M = rng.randint(100, 1000)
+            a = rng.randint(0, M)
+            b = rng.randint(a + 1, M)
             m = b - a
             assert m > 0
 
-            X = curand((N, M), dtype)
+            X_cpu = rng.rand(N, M).astype(dtype)
+            X = gpuarray.to_gpu(X_cpu, allocator=memory_pool.allocate)
             Y = extract_columns(X, a, b)
 
-            self.assertTrue(np.all(X.get()[:, a:b] == Y.get()))
+            self.assertTrue(np.all(X_cpu[:, a:b] == Y.get()))
 
     def test_insert_columns(self):
         for _ in range(20):
             dtype = random.choice((np.float32, np.float64))
-            N = np.random.randint(100, 1000)
-            M = np.random.randint(100, 1000)
-            m = np.random.randint(1, M)
-            offset = np.random.randint(0, M - m)
-
-            X = curand((N, M), dtype)
-            Y = curand((N, m), dtype)
+            N = rng.randint(100, 1000)
+            M = rng.randint(100, 1000)
+            m = rng.randint(1, M)
+            offset = rng.randint(0, M - m)
+
+            X_cpu = rng.rand(N, M).astype(dtype)
+            Y_cpu = rng.rand(N, m).astype(dtype)
+            X = gpuarray.to_gpu(X_cpu, allocator=memory_pool.allocate)
+            Y = gpuarray.to_gpu(Y_cpu, allocator=memory_pool.allocate)
             insert_columns(Y, X, offset)
 
-            self.assertTrue(np.all(X.get()[:, offset:offset+m] == Y.get()))
+            # Compare on the GPU and only move a single scalar back to
+            # the host instead of downloading all of X.
+            Z = extract_columns(X, offset, offset + m)
+            self.assertEqual(float(gpuarray.max(abs(Z - Y)).get()), 0.)
 
 
 class TestSampleDropoutMask(unittest.TestCase):
     TOL = 1e-3
 
+    def tearDown(self):
+        memory_pool.free_held()
+
     def test_sample_dropout_mask(self):
         for _ in range(20):
             height = 1000
             width = 10000
-            dropout_prob = np.random.rand()
+            dropout_prob = rng.rand()
             X = sampler.gen_uniform((height, width), np.float32)
             dropout_mask = sample_dropout_mask(X, dropout_prob)
-            dropout_rate = 1. - dropout_mask.get().mean()
+            mask_cpu = dropout_mask.get()
+            dropout_rate = 1. - mask_cpu.mean()
 
             self.assertLess(np.abs(dropout_prob - dropout_rate), self.TOL)
-            self.assertTrue(np.all((X.get() != 0.) == dropout_mask.get()))
+            self.assertTrue(np.all((X.get() != 0.) == mask_cpu))
 
     def test_sample_dropout_mask_columns(self):
         for _ in range(20):
             height = 10000
             width = 10000
-            dropout_prob = np.random.rand()
+            dropout_prob = rng.rand()
             X = sampler.gen_uniform((height, width), np.float32)
 
-            start = np.random.randint(0, width - 1000)
+            start = rng.randint(0, width - 1000)
             end = start + 1000
             columns = (start, end)
 
             dropout_mask = sample_dropout_mask(X, dropout_prob, columns)
-            dropout_rate = 1. - dropout_mask.get().mean()
+            mask_cpu = dropout_mask.get()
+            dropout_rate = 1. - mask_cpu.mean()
 
             self.assertEqual(dropout_mask.shape, (X.shape[0], end - start))
             self.assertLess(np.abs(dropout_prob - dropout_rate),
                             self.TOL)
             self.assertTrue(np.all((X.get()[:, start:end] != 0.)
-                                   == dropout_mask.get()))
+                                   == mask_cpu))
 
 class TestNeuralNetRegression(unittest.TestCase):
+    def tearDown(self):
+        memory_pool.free_held()
+
+    @staticmethod
+    def make_regression_problem(seed):
+        """ CPU side of one test iteration: sample a random linear
+        regression problem and compute the least-squares reference
+        solution.
+        """
+
+        r = np.random.RandomState(seed)
+        N = 10000    # Number of data points
+        D = 100      # Dimensionality of exogenous data
+        P = 50       # Dimensionality of endogenous data
+
+        W_true = 10 * r.rand(D, P) - 5
+        b_true = 100 * r.rand(P) - 50
+
+        X = r.randn(N, D)
+        Y = np.dot(X, W_true) + b_true[np.newaxis, :] + r.randn(N, P)
+
+        W_lstsq = np.linalg.lstsq(np.c_[np.ones((N, 1)), X], Y)[0]
+        W_lstsq = W_lstsq[1:]
+
+        return X, Y, W_lstsq
+
     def test_neural_net_regression(self):
-        for _ in range(20):
-            N = 10000    # Number of data points
-            D = 100      # Dimensionality of exogenous data
-            P = 50       # Dimensionality of endogenous data
-
-            W_true = 10 * np.random.rand(D, P) - 5
-            b_true = 100 * np.random.rand(P) - 50
-
-            X = np.random.randn(N, D)
-            Y = np.dot(X, W_true) + b_true[np.newaxis, :] + np.random.randn(N, P)        
-
-            W_lstsq = np.linalg.lstsq(np.c_[np.ones((N, 1)), X], Y)[0]
-            b_lstsq = W_lstsq[0]
-            W_lstsq = W_lstsq[1:]
-
-            data_provider = BatchDataProvider(gpuarray.to_gpu(X.astype(np.float32),
-                                                              allocator=memory_pool.allocate),
-                                              gpuarray.to_gpu(Y.astype(np.float32),
-                                                              allocator=memory_pool.allocate))
-
-            model = NeuralNetRegression([], n_in=D, n_out=P)
-            optimizer = SGD(model, SimpleSGDUpdate, 
-                            data_provider, data_provider,
-                            learning_rate_schedule=constant_scheduler(10.),
-                            early_stopping=True)
-            optimizer.run(100)
-
-            self.assertLess(np.abs(W_lstsq - model.top_layer.W.get()).max(),
-                            1e-5)
-        
+        # The CPU-side work (sampling the problem and the lstsq
+        # reference) is independent across iterations and BLAS releases
+        # the GIL, so prepare all problems on a thread pool while the
+        # GPU training below stays serial.
+        pool = ThreadPool()
+        try:
+            problems = pool.imap(self.make_regression_problem, range(20))
+            for X, Y, W_lstsq in problems:
+                D = X.shape[1]
+                P = Y.shape[1]
+
+                data_provider = BatchDataProvider(gpuarray.to_gpu(X.astype(np.float32),
+                                                                  allocator=memory_pool.allocate),
+                                                  gpuarray.to_gpu(Y.astype(np.float32),
+                                                                  allocator=memory_pool.allocate))
+
+                model = NeuralNetRegression([], n_in=D, n_out=P)
+                optimizer = SGD(model, SimpleSGDUpdate,
+                                data_provider, data_provider,
+                                learning_rate_schedule=constant_scheduler(10.),
+                                early_stopping=True)
+                optimizer.run(100)
+
+                np.testing.assert_allclose(model.top_layer.W.get(), W_lstsq,
+                                           rtol=0., atol=1e-5)
+        finally:
+            pool.close()
+            pool.join()
+
 if __name__ == '__main__':
     unittest.main()